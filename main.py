@@ -4,36 +4,38 @@ import socket
 import threading
 import time
 import json
+import struct
+import selectors
 import os
-import hashlib
-from dataclasses import dataclass
-from typing import List, Dict, Optional
-
-def ensure_pkg_resources():
-    try:
-        import pkg_resources
-        return pkg_resources
-    except ImportError:
-        print("Installing required setup tools...")
-        try:
-            subprocess.check_call([sys.executable, '-m', 'pip', 'install', '--upgrade', 'setuptools'])
-            import pkg_resources
-            return pkg_resources
-        except subprocess.CalledProcessError:
-            print("Failed to install setuptools. Please run:")
-            print(f"{sys.executable} -m pip install --upgrade setuptools")
-            sys.exit(1)
+import mmap
+import secrets
+import importlib
+import importlib.metadata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Iterator, List, Dict, Optional, Tuple
 
 def install_required_packages():
-    pkg_resources = ensure_pkg_resources()
-    
     required_packages = {
-        'python-vlc': 'vlc'
+        'python-vlc': 'vlc',
+        'blake3': 'blake3'
     }
     
-    installed_packages = {pkg.key for pkg in pkg_resources.working_set}
-    packages_to_install = [pkg for pkg, import_name in required_packages.items() 
-                          if pkg not in installed_packages]
+    # Importing is far cheaper than scanning every installed distribution,
+    # so only fall back to pip when an import actually fails
+    missing_packages = []
+    for pkg, import_name in required_packages.items():
+        try:
+            importlib.import_module(import_name)
+        except ImportError:
+            missing_packages.append(pkg)
+    
+    packages_to_install = []
+    if missing_packages:
+        installed_packages = {(dist.metadata["Name"] or "").lower().replace("_", "-")
+                              for dist in importlib.metadata.distributions()}
+        packages_to_install = [pkg for pkg in missing_packages if pkg not in installed_packages]
     
     if packages_to_install:
         print("Installing required packages...")
@@ -56,6 +58,54 @@ def install_required_packages():
 
 vlc_module = install_required_packages()
 
+import blake3
+
+try:
+    import orjson  # Optional: several times faster than json on every frame
+except ImportError:
+    orjson = None
+
+HASH_ALGORITHM = "blake3"
+HASH_CHUNK_SIZE = 1 << 20  # 1 MiB, for files that cannot be memory-mapped
+# A 32-bit process cannot map a whole multi-GiB movie into its address space
+MAX_MAPPED_SIZE = sys.maxsize if sys.maxsize > 2**32 else 1 << 31
+PREFETCH_SIZE = 64 << 20  # Head of the next file to pull in while hashing the current one
+HASH_CACHE_FILENAME = ".movie_sync_hashes.json"
+HASH_WORKERS = min(8, os.cpu_count() or 1)
+MEDIA_EXTENSIONS = frozenset({
+    '.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv',
+    '.mp3', '.wav', '.flac', '.m4a', '.aac',
+    '.webm', '.ogg'
+})
+
+# (path, size, mtime_ns) as stat'ed while scanning the media folder
+LocalFile = Tuple[str, int, int]
+
+# Bumped whenever host and client must agree on a change, such as the hash algorithm
+PROTOCOL_VERSION = 3
+
+# Every message on the wire is a 4-byte big-endian length followed by JSON
+FRAME_HEADER = struct.Struct(">I")
+RECV_SIZE = 65536
+CONTROL_SEND_BUFFER = 65536
+SEND_TIMEOUT = 1.0  # A control peer that stops reading is dropped after this long
+TRANSFER_TIMEOUT = 5 * SEND_TIMEOUT  # A download gives up when the host stalls this long
+TRANSFER_CHUNK_SIZE = 1 << 22  # 4 MiB
+SYNC_INTERVAL = 0.5  # Sync every 500ms
+FAST_SYNC_INTERVAL = 0.1  # Tighter ticks right after play/seek while clients converge
+FAST_SYNC_TICKS = 10
+PING_EVERY_TICKS = 20  # Refresh the round-trip estimate every 10s
+DELAY_WINDOW = 32  # Sync packets remembered for the delay baseline
+
+def get_local_ip():
+    try:
+        return socket.gethostbyname(socket.gethostname())
+    except socket.error:
+        return "0.0.0.0"
+
+# Resolved once: the lookup can block for seconds on a misconfigured resolver
+LOCAL_IP = get_local_ip()
+
 @dataclass
 class MediaFile:
     path: str
@@ -64,15 +114,61 @@ class MediaFile:
     hash: str
     index: int
 
+@dataclass
+class Connection:
+    # Incoming bytes live in buffer[start:end] and frames are parsed in place,
+    # so each byte is copied once by recv_into and once more into its frame
+    sock: socket.socket
+    buffer: bytearray = field(default_factory=lambda: bytearray(RECV_SIZE))
+    start: int = 0
+    end: int = 0
+    closed: bool = False
+
+    def receive(self) -> int:
+        if self.end == len(self.buffer):
+            self._make_room()
+        with memoryview(self.buffer) as view:
+            n = self.sock.recv_into(view[self.end:])
+        self.end += n
+        return n
+
+    def _make_room(self):
+        pending = self.end - self.start
+        if self.start:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        if self.end == len(self.buffer):
+            # A single frame is larger than the buffer
+            self.buffer.extend(bytes(len(self.buffer)))
+
+    def pop_frame(self) -> Optional[bytes]:
+        if self.end - self.start < FRAME_HEADER.size:
+            return None
+        (length,) = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        frame_end = self.start + FRAME_HEADER.size + length
+        if frame_end > self.end:
+            return None
+        with memoryview(self.buffer) as view:
+            payload = bytes(view[self.start + FRAME_HEADER.size:frame_end])
+        self.start = frame_end
+        if self.start == self.end:
+            self.start = self.end = 0
+        return payload
+
 class Playlist:
     def __init__(self):
         self.media_files: List[MediaFile] = []
         self.current_index: int = -1
+        self._by_index: Dict[int, MediaFile] = {}
         self._lock = threading.Lock()
 
     def add_file(self, media_file: MediaFile):
         with self._lock:
             self.media_files.append(media_file)
+            self._by_index[media_file.index] = media_file
+
+    def get_by_index(self, index: int) -> Optional[MediaFile]:
+        return self._by_index.get(index)
 
     def get_current_file(self) -> Optional[MediaFile]:
         if 0 <= self.current_index < len(self.media_files):
@@ -103,60 +199,193 @@ class Playlist:
 class FileHandler:
     @staticmethod
     def calculate_file_hash(filepath):
-        sha256_hash = hashlib.sha256()
+        # The hash only identifies content between peers, so BLAKE3's SIMD and
+        # multithreaded hashing beats SHA-256 at no cost to correctness
+        hasher = blake3.blake3(max_threads=blake3.blake3.AUTO)
         with open(filepath, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return hasher.hexdigest()  # Empty files cannot be mapped
+            try:
+                if size >= MAX_MAPPED_SIZE:
+                    raise OverflowError("file is too large to map")
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError, OverflowError):
+                # Too large for the address space, or on a network/FUSE filesystem
+                # that refuses mmap; stream instead
+                FileHandler.hash_stream(f, hasher)
+                return hasher.hexdigest()
+            with mm:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    # One-pass read: readahead aggressively and drop pages behind us
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                hasher.update(mm)
+        return hasher.hexdigest()
+
+    @staticmethod
+    def hash_stream(f, hasher):
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        buffer = bytearray(HASH_CHUNK_SIZE)
+        view = memoryview(buffer)
+        while n := f.readinto(buffer):
+            hasher.update(view[:n])
 
     @staticmethod
-    def get_file_info(filepath):
+    def prefetch(filepath):
+        # Start reading the file's head in the background so its hash doesn't
+        # begin with a cold seek; sequential readahead takes over from there
+        if not hasattr(os, "posix_fadvise"):
+            return
+        try:
+            fd = os.open(filepath, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, PREFETCH_SIZE, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+    @staticmethod
+    def get_file_info_cached(local_file: LocalFile, cache: Dict[LocalFile, str]):
+        filepath, size, _ = local_file
+        file_hash = cache.get(local_file)
+        if file_hash is None:
+            file_hash = FileHandler.calculate_file_hash(filepath)
+            cache[local_file] = file_hash
         return {
             "name": os.path.basename(filepath),
-            "size": os.path.getsize(filepath),
-            "hash": FileHandler.calculate_file_hash(filepath)
+            "size": size,
+            "hash": file_hash
         }
 
-def find_media_files(folder_path: str) -> List[str]:
-    media_extensions = [
-        '.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv',
-        '.mp3', '.wav', '.flac', '.m4a', '.aac',
-        '.webm', '.ogg'
-    ]
-    
+    @staticmethod
+    def load_hash_cache(folder_path) -> Dict[LocalFile, str]:
+        cache_path = os.path.join(folder_path, HASH_CACHE_FILENAME)
+        try:
+            with open(cache_path, "r") as f:
+                data = json.load(f)
+            if data.get("algorithm") != HASH_ALGORITHM:
+                return {}
+            return {(path, size, mtime_ns): file_hash for path, size, mtime_ns, file_hash in data["entries"]}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+            print(f"Ignoring unreadable hash cache: {e}")
+            return {}
+
+    @staticmethod
+    def is_unchanged(path, size, mtime_ns):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return stat.st_size == size and stat.st_mtime_ns == mtime_ns
+
+    @staticmethod
+    def save_hash_cache(folder_path, cache: Dict[LocalFile, str]):
+        cache_path = os.path.join(folder_path, HASH_CACHE_FILENAME)
+        # Entries for files that were since modified or removed are dropped
+        entries = [[path, size, mtime_ns, file_hash]
+                   for (path, size, mtime_ns), file_hash in list(cache.items())
+                   if FileHandler.is_unchanged(path, size, mtime_ns)]
+        try:
+            # Write-then-rename so a crash never leaves a truncated cache behind
+            with open(cache_path + ".tmp", "w") as f:
+                json.dump({"algorithm": HASH_ALGORITHM, "entries": entries}, f)
+            os.replace(cache_path + ".tmp", cache_path)
+        except OSError as e:
+            print(f"Failed to save hash cache: {e}")
+
+def find_media_files(folder_path: str) -> List[LocalFile]:
     media_files = []
     try:
-        for file in os.listdir(folder_path):
-            if any(file.lower().endswith(ext) for ext in media_extensions):
-                full_path = os.path.join(folder_path, file)
-                media_files.append(full_path)
+        # Absolute paths keep hash cache keys stable whatever the working directory
+        with os.scandir(os.path.abspath(folder_path)) as entries:
+            for entry in entries:
+                if os.path.splitext(entry.name)[1].lower() in MEDIA_EXTENSIONS and entry.is_file():
+                    stat = entry.stat()
+                    media_files.append((entry.path, stat.st_size, stat.st_mtime_ns))
     except Exception as e:
         print(f"Error scanning folder: {e}")
     
     return sorted(media_files)
 
+def encode_frame(command) -> bytes:
+    if orjson:
+        payload = orjson.dumps(command)
+    else:
+        payload = json.dumps(command, separators=(',', ':')).encode()
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def decode_frame(payload: bytes):
+    # Malformed payloads raise ValueError from either library: orjson's
+    # JSONDecodeError, or json's JSONDecodeError / UnicodeDecodeError
+    return orjson.loads(payload) if orjson else json.loads(payload)
+
+def configure_socket(sock: socket.socket):
+    # Sync commands are tiny and latency critical; don't let Nagle hold them back
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+def bound_send_buffer(sock: socket.socket):
+    # Only for control connections: a small, fixed send buffer keeps queued
+    # commands from piling up behind a slow peer, and gets a stuck peer dropped
+    # by SEND_TIMEOUT sooner, but would throttle transfers
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, CONTROL_SEND_BUFFER)
+
 class VLCSync:
-    def __init__(self, is_host=False, host_ip=None, folder_path=None):
+    def __init__(self, is_host=False, host_ip=None, folder_path=None, verify_hashes=False):
         self.is_host = is_host
-        self.host_ip = host_ip if not is_host else socket.gethostbyname(socket.gethostname())
+        self.verify_hashes = verify_hashes
+        self.host_ip = host_ip if not is_host else LOCAL_IP
         self.port = 5000
         self.vlc_instance = vlc_module.Instance()
         self.player = self.vlc_instance.media_player_new()
+        self._playing_event = threading.Event()
+        self.player.event_manager().event_attach(
+            vlc_module.EventType.MediaPlayerPlaying, lambda event: self._playing_event.set()
+        )
         self.folder_path = folder_path
         self.playlist = Playlist()
         self.clients: List[socket.socket] = []
         self.server_socket = None
         self.client_socket = None
+        self._selector = selectors.DefaultSelector()
+        # Lets cleanup() wake the event loop out of an untimed select()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._selector.register(self._wakeup_reader, selectors.EVENT_READ)
         self.running = True
+        self._stop = threading.Event()
+        # Set on state changes so the next sync goes out without waiting for a tick
+        self._sync_wake = threading.Event()
         self.sync_thread = None
         self.missing_files: Dict[int, MediaFile] = {}
+        # Guards the playlist stream so a joining client gets every entry exactly once
+        self._playlist_lock = threading.Lock()
+        # Every playlist frame broadcast so far, replayed as-is to joining clients
+        self._playlist_payload = bytearray()
+        self._local_by_size: Dict[int, List[LocalFile]] = {}
+        self._downloads = set()
+        # Handed out in the hello reply; file requests must present one
+        self._session_tokens: Dict[str, socket.socket] = {}
+        self._transfer_token: Optional[str] = None
+        # One lock per socket: frames to a peer never interleave, and a slow
+        # peer only holds up sends to itself
+        self._send_locks: Dict[socket.socket, threading.Lock] = {}
+        self._pings: Dict[int, float] = {}
+        self._next_ping_id = 0
+        self._rtt_samples = deque(maxlen=8)
+        self._sync_offsets = deque(maxlen=DELAY_WINDOW)
+        self._hash_cache: Dict[LocalFile, str] = (
+            FileHandler.load_hash_cache(folder_path) if folder_path else {}
+        )
         
         if self.is_host:
             self.setup_server()
         else:
             self.setup_client()
             
-        if folder_path:
+        if folder_path and self.is_host:
             self.load_playlist(folder_path)
                 
         self.start_sync_thread()
@@ -164,10 +393,12 @@ class VLCSync:
     def setup_server(self):
         try:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.bind((self.host_ip, self.port))
+            # Listen on every interface; host_ip is only shown to the user
+            self.server_socket.bind(("0.0.0.0", self.port))
             self.server_socket.listen(5)
             print(f"Server started on {self.host_ip}:{self.port}")
-            threading.Thread(target=self.accept_connections, daemon=True).start()
+            self._selector.register(self.server_socket, selectors.EVENT_READ)
+            threading.Thread(target=self.event_loop, daemon=True).start()
         except socket.error as e:
             print(f"Failed to start server: {e}")
             sys.exit(1)
@@ -176,103 +407,156 @@ class VLCSync:
         try:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client_socket.connect((self.host_ip, self.port))
+            self.client_socket.settimeout(SEND_TIMEOUT)
+            configure_socket(self.client_socket)
+            bound_send_buffer(self.client_socket)
             print(f"Connected to host at {self.host_ip}:{self.port}")
-            threading.Thread(target=self.receive_commands, daemon=True).start()
+            # Joins the broadcast; file transfers use their own connections instead
+            self.send_command({"type": "hello", "version": PROTOCOL_VERSION}, self.client_socket)
+            self._selector.register(self.client_socket, selectors.EVENT_READ, Connection(self.client_socket))
+            threading.Thread(target=self.event_loop, daemon=True).start()
         except socket.error as e:
             print(f"Failed to connect to host: {e}")
             sys.exit(1)
 
     def load_playlist(self, folder_path: str):
-        media_paths = find_media_files(folder_path)
-        for index, path in enumerate(media_paths):
-            file_info = FileHandler.get_file_info(path)
+        local_files = find_media_files(folder_path)
+        with self._playlist_lock:
+            self._playlist_payload = bytearray()
+            self.broadcast_playlist_command({"type": "playlist_begin", "count": len(local_files)})
+
+        # Each entry goes out as soon as it is hashed so clients can start matching
+        infos = self.iter_file_infos(local_files)
+        for index, (local_file, file_info) in enumerate(zip(local_files, infos)):
             media_file = MediaFile(
-                path=path,
+                path=local_file[0],
                 name=file_info["name"],
                 size=file_info["size"],
                 hash=file_info["hash"],
                 index=index
             )
-            self.playlist.add_file(media_file)
-        
-        if self.is_host:
-            self.broadcast_playlist()
-
-    def broadcast_playlist(self):
-        playlist_info = [
-            {
-                "name": media.name,
-                "size": media.size,
-                "hash": media.hash,
-                "index": media.index
-            }
-            for media in self.playlist.media_files
-        ]
-        self.broadcast_command({
-            "type": "playlist_info",
-            "playlist": playlist_info
-        })
-
-    def accept_connections(self):
+            with self._playlist_lock:
+                self.playlist.add_file(media_file)
+                self.broadcast_playlist_command({"type": "playlist_add", "entry": self.playlist_entry(media_file)})
+
+        with self._playlist_lock:
+            self.broadcast_playlist_command({"type": "playlist_end"})
+        FileHandler.save_hash_cache(folder_path, self._hash_cache)
+
+    def iter_file_infos(self, local_files: List[LocalFile]) -> Iterator[dict]:
+        # Hashing releases the GIL, so threads overlap disk reads with hashing.
+        # Only cache misses go to the pool, which is sized to the work at hand.
+        misses = [local_file for local_file in local_files if local_file not in self._hash_cache]
+        workers = max(1, min(HASH_WORKERS, len(misses)))
+
+        def hash_miss(i):
+            # The file a worker will pick up after this batch is warmed meanwhile
+            if i + workers < len(misses):
+                FileHandler.prefetch(misses[i + workers][0])
+            return FileHandler.get_file_info_cached(misses[i], self._hash_cache)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {local_file: executor.submit(hash_miss, i) for i, local_file in enumerate(misses)}
+            for local_file in local_files:
+                if local_file in pending:
+                    yield pending[local_file].result()
+                else:
+                    yield FileHandler.get_file_info_cached(local_file, self._hash_cache)
+
+    @staticmethod
+    def playlist_entry(media: MediaFile):
+        # Positional [name, size, hash, index] instead of repeating keys per entry
+        return [media.name, media.size, media.hash, media.index]
+
+    def broadcast_playlist_command(self, command):
+        # Called with _playlist_lock held; the frame is encoded once and kept for late joiners
+        frame = encode_frame(command)
+        self._playlist_payload += frame
+        self.broadcast_frame(frame)
+
+    def send_playlist(self, client_socket):
+        # Called with _playlist_lock held, so later entries reach the client by broadcast
+        if self._playlist_payload:
+            self.send_frame(self._playlist_payload, client_socket)
+
+    def event_loop(self):
+        # One thread services the listening socket and every connection
         while self.running:
+            for key, _ in self._selector.select():
+                if key.fileobj is self._wakeup_reader:
+                    return
+                elif key.fileobj is self.server_socket:
+                    self._on_accept()
+                else:
+                    self._on_client_data(key.data)
+
+    def _on_accept(self):
+        try:
+            client_socket, address = self.server_socket.accept()
+        except OSError as e:
+            if self.running:
+                print(f"Error accepting connection: {e}")
+            return
+        print(f"Client connected from {address}")
+        # The selector only reads when data is ready, so the timeout bounds sends
+        client_socket.settimeout(SEND_TIMEOUT)
+        configure_socket(client_socket)
+        self._selector.register(client_socket, selectors.EVENT_READ, Connection(client_socket))
+
+    def _on_client_data(self, connection: Connection):
+        try:
+            received = connection.receive()
+        except OSError:
+            received = 0
+        if not received:
+            self._close_connection(connection)
+            return
+
+        # A handler may close the connection; frames still buffered are then dropped
+        while not connection.closed and (payload := connection.pop_frame()) is not None:
             try:
-                self.server_socket.settimeout(1.0)
-                try:
-                    client_socket, address = self.server_socket.accept()
-                    print(f"Client connected from {address}")
-                    self.clients.append(client_socket)
-                    threading.Thread(target=self.handle_client, args=(client_socket,), daemon=True).start()
-                except socket.timeout:
-                    continue
+                command = decode_frame(payload)
+            except ValueError:
+                # Covers JSONDecodeError and, with the json module, UnicodeDecodeError
+                print("Failed to decode command")
+                self._close_connection(connection)
+                return
+            try:
+                self.handle_command(command, connection.sock if self.is_host else None)
             except Exception as e:
                 if self.running:
-                    print(f"Error accepting connection: {e}")
+                    print(f"Error handling command: {e}")
+                self._close_connection(connection)
+                return
 
-    def handle_client(self, client_socket):
+    def _close_connection(self, connection: Connection):
+        if connection.closed:
+            return
+        connection.closed = True
         try:
-            while self.running:
-                client_socket.settimeout(1.0)
-                try:
-                    data = client_socket.recv(1024)
-                    if not data:
-                        break
-                    command = json.loads(data.decode())
-                    self.handle_command(command, client_socket)
-                except socket.timeout:
-                    continue
-                except json.JSONDecodeError:
-                    print(f"Failed to decode command from client")
-        except:
+            self._selector.unregister(connection.sock)
+        except (KeyError, ValueError):
             pass
-        finally:
-            if client_socket in self.clients:
-                self.clients.remove(client_socket)
-            client_socket.close()
+        connection.sock.close()
+        self._send_locks.pop(connection.sock, None)
+        self._session_tokens = {token: sock for token, sock in self._session_tokens.items()
+                                if sock is not connection.sock}
+        if self.is_host:
+            if connection.sock in self.clients:
+                self.clients.remove(connection.sock)
             print("Client disconnected")
-
-    def receive_commands(self):
-        while self.running:
-            try:
-                self.client_socket.settimeout(1.0)
-                try:
-                    data = self.client_socket.recv(1024)
-                    if not data:
-                        break
-                    command = json.loads(data.decode())
-                    self.handle_command(command)
-                except socket.timeout:
-                    continue
-            except Exception as e:
-                if self.running:
-                    print(f"Error receiving command: {e}")
-                break
-        print("Disconnected from host")
+        else:
+            print("Disconnected from host")
 
     def handle_command(self, command, client_socket=None):
         cmd_type = command["type"]
         
-        if cmd_type == "playlist_info":
-            self.handle_playlist_info(command["playlist"])
+        if cmd_type == "playlist_begin":
+            self.handle_playlist_begin(command)
+        elif cmd_type == "playlist_add":
+            self.handle_playlist_add(command["entry"])
+        elif cmd_type == "playlist_end":
+            self.handle_playlist_end()
         elif cmd_type == "play_file":
             file_index = command["index"]
             if self.verify_and_load_file(file_index):
@@ -293,50 +577,96 @@ class VLCSync:
         elif cmd_type == "sync":
             if not self.is_host:
                 self.handle_sync(command)
+        elif cmd_type == "hello":
+            if self.is_host and client_socket:
+                self.handle_hello(command, client_socket)
+        elif cmd_type == "welcome":
+            self._transfer_token = command["token"]
+        elif cmd_type == "rejected":
+            print(f"Host refused the connection: {command['reason']}")
         elif cmd_type == "ping":
             if self.is_host and client_socket:
-                self.send_command({"type": "pong"}, client_socket)
+                self.send_command({"type": "pong", "id": command.get("id")}, client_socket)
+        elif cmd_type == "pong":
+            if not self.is_host:
+                self.handle_pong(command)
         elif cmd_type == "request_file":
-            if self.is_host:
-                self.handle_file_request(command)
+            if self.is_host and client_socket:
+                self.handle_file_request(command, client_socket)
 
-    def handle_playlist_info(self, playlist_info):
+    def handle_hello(self, command, client_socket):
+        version = command.get("version")
+        if version != PROTOCOL_VERSION:
+            # Peers on another version would never match each other's hashes
+            print(f"Rejecting client running protocol version {version}")
+            self.send_command({
+                "type": "rejected",
+                "reason": f"host runs protocol version {PROTOCOL_VERSION}, client runs {version}"
+            }, client_socket)
+            self._close_connection(self._selector.get_key(client_socket).data)
+            return
+        bound_send_buffer(client_socket)
+        token = secrets.token_hex(16)
+        self._session_tokens[token] = client_socket
+        self.send_command({"type": "welcome", "token": token}, client_socket)
+        with self._playlist_lock:
+            self.clients.append(client_socket)
+            self.send_playlist(client_socket)
+        self._sync_wake.set()
+
+    def handle_playlist_begin(self, command):
+        print(f"Receiving playlist of {command['count']} files...")
         self.playlist = Playlist()
-        missing_files = []
-        
-        for file_info in playlist_info:
-            local_path = self.find_matching_file(file_info)
-            media_file = MediaFile(
-                path=local_path if local_path else "",
-                name=file_info["name"],
-                size=file_info["size"],
-                hash=file_info["hash"],
-                index=file_info["index"]
-            )
-            self.playlist.add_file(media_file)
-            
-            if not local_path:
-                missing_files.append(media_file)
-                self.missing_files[media_file.index] = media_file
+        self.missing_files = {}
+        self._local_by_size = self.index_local_files()
+
+    def handle_playlist_add(self, entry):
+        name, size, file_hash, index = entry
+        local_path = self.find_matching_file(name, size, file_hash)
+        media_file = MediaFile(
+            path=local_path if local_path else "",
+            name=name,
+            size=size,
+            hash=file_hash,
+            index=index
+        )
+        self.playlist.add_file(media_file)
         
-        if missing_files:
+        if not local_path:
+            self.missing_files[media_file.index] = media_file
+
+    def handle_playlist_end(self):
+        if self.missing_files:
             print("\nMissing files:")
-            for file in missing_files:
+            for file in self.missing_files.values():
                 print(f"  - {file.name}")
             print("\nPlease ensure you have all required files in your media folder.")
 
-    def find_matching_file(self, file_info):
+    def index_local_files(self) -> Dict[int, List[LocalFile]]:
         if not self.folder_path:
-            return None
+            return {}
         
-        for file_path in find_media_files(self.folder_path):
-            local_info = FileHandler.get_file_info(file_path)
-            if local_info["hash"] == file_info["hash"]:
-                return file_path
+        local_by_size: Dict[int, List[LocalFile]] = {}
+        for local_file in find_media_files(self.folder_path):
+            local_by_size.setdefault(local_file[1], []).append(local_file)
+        return local_by_size
+
+    def find_matching_file(self, name, size, file_hash):
+        # A file whose size differs cannot match by hash, so only same-size files get hashed
+        candidates = self._local_by_size.get(size, [])
+        if not self.verify_hashes:
+            # Same name and size is trusted without reading the file
+            for local_file in candidates:
+                if os.path.basename(local_file[0]) == name:
+                    return local_file[0]
+        for local_file in candidates:
+            local_info = FileHandler.get_file_info_cached(local_file, self._hash_cache)
+            if local_info["hash"] == file_hash:
+                return local_file[0]
         return None
 
     def verify_and_load_file(self, file_index):
-        media_file = next((mf for mf in self.playlist.media_files if mf.index == file_index), None)
+        media_file = self.playlist.get_by_index(file_index)
         if not media_file:
             print(f"File index {file_index} not found in playlist.")
             return False
@@ -352,42 +682,146 @@ class VLCSync:
         return True
 
     def request_file(self, file_index):
-        if not self.is_host:
-            self.send_command({
-                "type": "request_file",
-                "index": file_index
-            }, self.client_socket)
+        if self.is_host or not self.folder_path or file_index in self._downloads:
+            return
+        media_file = self.playlist.get_by_index(file_index)
+        if media_file:
+            self._downloads.add(file_index)
+            threading.Thread(target=self.download_file, args=(media_file,), daemon=True).start()
 
-    def handle_file_request(self, command):
-        file_index = command["index"]
-        media_file = next((mf for mf in self.playlist.media_files if mf.index == file_index), None)
-        if media_file and os.path.exists(media_file.path):
-            print(f"Client requested file: {media_file.name}")
-            print("File transfer not implemented in this version.")
+    def download_file(self, media_file: MediaFile):
+        name = os.path.basename(media_file.name)  # Never write outside the media folder
+        # Absolute, like the paths find_media_files keys the hash cache by
+        target_path = os.path.join(os.path.abspath(self.folder_path), name)
+        partial_path = target_path + ".part"
+        print(f"Downloading {name} from host...")
+        try:
+            if os.path.exists(target_path):
+                # The local file by that name didn't match; never overwrite it
+                raise ValueError("a different local file already has this name")
+            with socket.create_connection((self.host_ip, self.port), timeout=TRANSFER_TIMEOUT) as sock:
+                sock.sendall(encode_frame({
+                    "type": "request_file",
+                    "index": media_file.index,
+                    "token": self._transfer_token
+                }))
+                connection = Connection(sock)
+                while (payload := connection.pop_frame()) is None:
+                    if not connection.receive():
+                        raise ConnectionError("host closed the connection")
+                remaining = decode_frame(payload)["size"]
+
+                hasher = blake3.blake3()
+                chunk = bytearray(TRANSFER_CHUNK_SIZE)
+                view = memoryview(chunk)
+                with open(partial_path, "wb") as f:
+                    # Bytes that arrived together with the header are file data
+                    head = connection.buffer[connection.start:min(connection.end, connection.start + remaining)]
+                    f.write(head)
+                    hasher.update(head)
+                    remaining -= len(head)
+                    while remaining > 0:
+                        n = sock.recv_into(view[:min(remaining, len(chunk))])
+                        if not n:
+                            raise ConnectionError("host closed the connection")
+                        f.write(view[:n])
+                        hasher.update(view[:n])
+                        remaining -= n
 
-    def measure_latency(self):
-        if not self.is_host and self.client_socket:
+            if hasher.hexdigest() != media_file.hash:
+                raise ValueError("downloaded file does not match the host's hash")
+            if os.path.exists(target_path):
+                raise ValueError("a different local file already has this name")
+            os.replace(partial_path, target_path)
+            stat = os.stat(target_path)
+            self._hash_cache[(target_path, stat.st_size, stat.st_mtime_ns)] = media_file.hash
+            media_file.path = target_path
+            self.missing_files.pop(media_file.index, None)
+            print(f"Downloaded {name}")
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Failed to download {name}: {e}")
             try:
-                start_time = time.time()
-                self.send_command({"type": "ping"}, self.client_socket)
-                self.client_socket.settimeout(1.0)
-                data = self.client_socket.recv(1024)
-                if data and json.loads(data.decode())["type"] == "pong":
-                    end_time = time.time()
-                    return (end_time - start_time) * 1000
-            except:
+                os.remove(partial_path)
+            except OSError:
                 pass
-        return 0
+        finally:
+            self._downloads.discard(media_file.index)
 
-    def play(self):
+    def handle_file_request(self, command, client_socket):
+        if client_socket in self.clients:
+            # Handing a control connection to a transfer would mix broadcasts into the file
+            print("Ignoring file request on a control connection")
+            return
+        if command.get("token") not in self._session_tokens:
+            print("Refusing file request from a peer without a valid session")
+            self._close_connection(self._selector.get_key(client_socket).data)
+            return
+        # The requesting connection is dedicated to this transfer from here on
+        self._selector.unregister(client_socket)
+        client_socket.settimeout(None)
+        media_file = self.playlist.get_by_index(command["index"])
+        if media_file and os.path.exists(media_file.path):
+            print(f"Client requested file: {media_file.name}")
+            threading.Thread(target=self.send_file, args=(media_file, client_socket), daemon=True).start()
+        else:
+            client_socket.close()
+
+    def send_file(self, media_file: MediaFile, client_socket):
+        try:
+            with open(media_file.path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                client_socket.sendall(encode_frame({"type": "file_data", "index": media_file.index, "size": size}))
+                # sendfile(2) copies straight from the page cache to the socket
+                client_socket.sendfile(f)
+        except OSError as e:
+            print(f"Failed to send {media_file.name}: {e}")
+        finally:
+            client_socket.close()
+
+    def send_ping(self):
+        ping_id = self._next_ping_id
+        self._next_ping_id += 1
+        self._pings[ping_id] = time.monotonic()
+        self.send_command({"type": "ping", "id": ping_id}, self.client_socket)
+
+    def handle_pong(self, command):
+        sent_at = self._pings.pop(command.get("id"), None)
+        if sent_at is None:
+            return
+        self._rtt_samples.append((time.monotonic() - sent_at) * 1000)
+
+    def estimate_latency(self, host_timestamp_ns):
+        # Host and client clocks are unrelated, so local receive time minus the
+        # host's send time is only meaningful relative to other samples: the
+        # smallest recent value is the fastest delivery, and anything above it
+        # is extra delay on this packet. The fastest delivery itself is taken
+        # as half the best recent ping round trip.
+        offset_ns = time.monotonic_ns() - host_timestamp_ns
+        self._sync_offsets.append(offset_ns)
+        queuing_ms = (offset_ns - min(self._sync_offsets)) / 1e6
+        base_ms = min(self._rtt_samples) / 2 if self._rtt_samples else 0
+        return base_ms + queuing_ms
+
+    def play_and_wait(self):
+        # VLC starts asynchronously; wait for its Playing event rather than a
+        # fixed sleep so the reported time is valid as soon as possible
+        already_playing = self.player.is_playing()
+        self._playing_event.clear()
         self.player.play()
+        if not already_playing:
+            self._playing_event.wait(timeout=0.2)
+
+    def play(self):
         if self.is_host:
-            time.sleep(0.1)  # Small delay to ensure playback has started
+            self.play_and_wait()
             current_time = self.player.get_time()
             self.broadcast_command({
                 "type": "play",
                 "time": current_time
             })
+            self._sync_wake.set()
+        else:
+            self.player.play()
 
     def pause(self):
         self.player.pause()
@@ -398,18 +832,19 @@ class VLCSync:
         self.player.set_time(time_ms)
         if self.is_host:
             self.broadcast_command({"type": "seek", "time": time_ms})
+            self._sync_wake.set()
 
     def play_file(self, index):
         if self.verify_and_load_file(index):
             if self.is_host:
-                self.player.play()
-                time.sleep(0.1)  # Small delay to ensure playback has started
+                self.play_and_wait()
                 current_time = self.player.get_time()
                 self.broadcast_command({
                     "type": "play_file",
                     "index": index,
                     "time": current_time
                 })
+                self._sync_wake.set()
             else:
                 self.play()
 
@@ -424,22 +859,33 @@ class VLCSync:
             self.play_file(prev_media.index)
 
     def send_command(self, command, client_socket):
+        self.send_frame(encode_frame(command), client_socket)
+
+    def send_frame(self, frame: bytes, client_socket):
         try:
-            client_socket.send(json.dumps(command).encode())
+            with self._send_locks.setdefault(client_socket, threading.Lock()):
+                client_socket.sendall(frame)
         except:
             if client_socket in self.clients:
                 self.clients.remove(client_socket)
-                print("Client disconnected")
+            # The event loop sees EOF and closes the connection on its own thread
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
     def broadcast_command(self, command):
+        self.broadcast_frame(encode_frame(command))  # Serialize once for every client
+
+    def broadcast_frame(self, frame: bytes):
         for client in self.clients[:]:  # Use a slice copy to avoid modification during iteration
-            self.send_command(command, client)
+            self.send_frame(frame, client)
 
     def handle_sync(self, command):
+        latency = self.estimate_latency(command["t"])  # One-way latency
         if not self.is_host and self.player.is_playing():
-            host_time = command["time"]
+            host_time = command["pos"]
             current_time = self.player.get_time()
-            latency = self.measure_latency() / 2  # One-way latency
             
             # Adjust host_time by adding latency
             adjusted_host_time = host_time + int(latency)
@@ -466,20 +912,43 @@ class VLCSync:
         self.sync_thread.start()
 
     def sync_playback(self):
-        SYNC_INTERVAL = 0.5  # Sync every 500ms
-        
-        while self.running:
-            time.sleep(SYNC_INTERVAL)
+        # Ticks stay on a fixed grid however long each iteration takes: every
+        # 500ms, tightened to 100ms for a burst after each state change
+        next_tick = time.monotonic()
+        tick = 0
+        fast_ticks = 0
+        while not self._stop.is_set():
+            interval = FAST_SYNC_INTERVAL if fast_ticks else SYNC_INTERVAL
+            fast_ticks = max(0, fast_ticks - 1)
+            next_tick += interval
+            woken = self._sync_wake.wait(max(0.0, next_tick - time.monotonic()))
+            if self._stop.is_set():
+                break
+            if woken:
+                self._sync_wake.clear()
+                next_tick = time.monotonic()  # Restart the grid from the state change
+                fast_ticks = FAST_SYNC_TICKS
+            elif time.monotonic() - next_tick > interval:
+                next_tick = time.monotonic()  # Stalled past a whole tick; don't burst to catch up
             
-            if self.is_host and self.player.is_playing():
+            if self.is_host and self.clients and self.player.is_playing():
                 current_time = self.player.get_time()
                 self.broadcast_command({
                     "type": "sync",
-                    "time": current_time
+                    "t": time.monotonic_ns(),
+                    "pos": current_time
                 })
+            elif not self.is_host and self.client_socket and tick % PING_EVERY_TICKS == 0:
+                # Sync packets carry the host timestamp, so only an occasional
+                # ping is needed to anchor the delay estimate
+                self.send_ping()
+            tick += 1
 
     def cleanup(self):
         self.running = False
+        self._stop.set()
+        self._sync_wake.set()
+        self._wakeup_writer.send(b"\0")
         if self.is_host:
             if self.server_socket:
                 self.server_socket.close()
@@ -491,6 +960,8 @@ class VLCSync:
         else:
             if self.client_socket:
                 self.client_socket.close()
+        if self.folder_path:
+            FileHandler.save_hash_cache(self.folder_path, self._hash_cache)
         self.player.stop()
 
 def main():
@@ -508,8 +979,7 @@ def main():
         is_host = choice == 'y'
         
         if is_host:
-            host_ip = socket.gethostbyname(socket.gethostname())
-            print(f"Your IP address is: {host_ip}")
+            print(f"Your IP address is: {LOCAL_IP}")
             sync = VLCSync(is_host=True, folder_path=folder_path)
             
             if not sync.playlist.media_files:
@@ -560,7 +1030,9 @@ def main():
                     print(f"Error executing command: {e}")
         else:
             host_ip = input("Enter the host's IP address: ")
-            sync = VLCSync(is_host=False, host_ip=host_ip, folder_path=folder_path)
+            verify_hashes = "--verify-hash" in sys.argv[1:]
+            sync = VLCSync(is_host=False, host_ip=host_ip, folder_path=folder_path,
+                           verify_hashes=verify_hashes)
             print("Connected to host. Waiting for playlist information...")
             
             print("\nAvailable commands:")